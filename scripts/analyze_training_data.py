@@ -1,7 +1,6 @@
 import glob
 import json
 import os
-import pickle
 from pathlib import Path
 
 import pandas as pd
@@ -9,7 +8,7 @@ import torch
 from tqdm import tqdm
 
 from core.visualize import check_collision
-from data.data_manager import GraspCacheEntry
+from data.data_manager import GraspCache, GraspCacheEntry
 from data.util import CPU_Unpickler
 
 
@@ -21,8 +20,7 @@ def get_mesh_path_from_h5(h5_filename: str) -> str:
 
 
 if __name__ == "__main__":
-    with open("data/grasp_cache/grasp_cache.pkl", "rb") as f:
-        cache: dict[str, GraspCacheEntry] = pickle.load(f)
+    cache: dict[str, GraspCacheEntry] = GraspCache("data/grasp_cache").cache
 
     print(f"Loaded {len(cache)} cache entries")
 
@@ -70,11 +68,12 @@ if __name__ == "__main__":
             value.centroid, device=translation.device
         )
 
-        has_collision, scene, min_distance, is_graspable = check_collision(
+        has_collision, _, min_distance, is_graspable = check_collision(
             rotation,
             final_translation,
             mesh_path,
             value.dataset_mesh_scale,
+            return_scene=False,
         )
 
         # Create entry for each grasp
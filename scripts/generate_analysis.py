@@ -2,15 +2,22 @@ import glob
 import json
 import os
 import pickle
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Tuple
+from typing import List, Tuple
 
+import numpy as np
 import pandas as pd
 import torch
 
 from core.visualize import check_collision
-from data.data_manager import GraspCacheEntry
+from data.data_manager import (
+    CacheIndex,
+    GraspCache,
+    GraspCacheEntry,
+    index_grasp_cache,
+)
 from data.util import CPU_Unpickler, denormalize_translation
 from models.util import get_grasp_from_batch
 
@@ -66,37 +73,26 @@ def load_grasp_results(grasp_dir: str, meshes_dir: str) -> list[GraspResult]:
 
 
 def match_grasp_cache(
-    result: GraspResult, cache: dict[str, GraspCacheEntry]
+    result: GraspResult, index: CacheIndex
 ) -> Tuple[str, GraspCacheEntry]:
     """Find matching cache entry based on mesh name and normalization scale.
 
+    Args:
+        result: Grasp result to match
+        index: Cache index built with index_grasp_cache
+
     Raises:
-        ValueError: If multiple matching cache entries are found or if invalid cache filename
+        ValueError: If multiple matching cache entries are found
     """
     TOLERANCE = 1e-9
     item_name = result.mesh_path.parent.name
     item_id = result.mesh_path.stem
 
-    matches: list[Tuple[str, GraspCacheEntry]] = []
-
-    for filename, entry in cache.items():
-        if not filename.endswith(".h5"):
-            raise ValueError(f"Invalid cache filename: {filename}")
-
-        # Parse cache filename: "item_name_item_id_norm_params.h5"
-        parts = filename[:-3].split("_")  # Remove .h5 and split
-        cache_id = parts[-2]
-        cache_mesh_scale = float(parts[-1])
-        cache_name = "_".join(parts[:-2])  # Handle names with underscores
-
-        if item_name == cache_name and item_id == cache_id:
-            # print(f"Found matching cache entry: {filename}")
-            # print("Result mesh scale:", result.mesh_scale)
-            # print("Cache mesh scale:", cache_mesh_scale)
-
-            if abs(result.mesh_scale - cache_mesh_scale) < TOLERANCE:
-                # if str(entry.normalization_scale).startswith(f"{result.norm_scale:.3f}"):
-                matches.append((filename, entry))
+    matches: list[Tuple[str, GraspCacheEntry]] = [
+        (filename, entry)
+        for cache_mesh_scale, filename, entry in index.get((item_name, item_id), [])
+        if abs(result.mesh_scale - cache_mesh_scale) < TOLERANCE
+    ]
 
     if not matches:
         raise ValueError(f"No matching cache entry found for {item_name} {item_id}")
@@ -113,12 +109,63 @@ def match_grasp_cache(
     return matches[0]
 
 
+def final_translations(
+    results: list[GraspResult],
+    matches: list[GraspCacheEntry],
+    norm_params,
+) -> list[torch.Tensor]:
+    """Denormalize the translations of all results at once and adjust them by the
+    centroid of their matching cache entry.
+
+    Results may hold different numbers of grasps, so they are concatenated and
+    split back.
+    """
+    if not results:
+        return []
+
+    num_grasps = [len(result.translations) for result in results]
+    translations = torch.cat([result.translations for result in results])
+    centroids = torch.tensor(
+        np.stack([match.centroid for match in matches]), device=translations.device
+    )
+    grasp_centroids = centroids.repeat_interleave(
+        torch.tensor(num_grasps, device=translations.device), dim=0
+    )
+    denormalized = denormalize_translation(translations, norm_params)
+    return list((denormalized + grasp_centroids).split(num_grasps))
+
+
+def _init_worker() -> None:
+    """There is one worker per core, so each one runs single threaded."""
+    torch.set_num_threads(1)
+
+
+def _check_one(
+    args: Tuple[torch.Tensor, torch.Tensor, Path, float],
+) -> Tuple[List[bool], List[float], List[bool]]:
+    """Check the grasps of one result for collisions.
+
+    Returns:
+        Tuple of (has_collision, min_distance, is_graspable)
+    """
+    rotations, final_translation, mesh_path, dataset_mesh_scale = args
+
+    has_collision, _, min_distance, is_graspable = check_collision(
+        rotations,
+        final_translation,
+        mesh_path,
+        dataset_mesh_scale,
+        return_scene=False,
+        workers=1,
+    )
+    return has_collision, min_distance, is_graspable
+
+
 if __name__ == "__main__":
     # Load grasp results and cache
     results = load_grasp_results("grasp_results", "data/meshes")
 
-    with open("data/grasp_cache/grasp_cache.pkl", "rb") as f:
-        cache = pickle.load(f)
+    cache = GraspCache("data/grasp_cache").cache
 
     print(f"Loaded {len(cache)} cache entries")
 
@@ -136,32 +183,43 @@ if __name__ == "__main__":
     # Initialize lists to store data
     grasp_data = []
 
+    # Parse the cache filenames once instead of scanning the cache per result
+    cache_index = index_grasp_cache(cache)
+    matches = [match_grasp_cache(result, cache_index)[1] for result in results]
+
+    # Denormalize and adjust translation with centroid, for all results at once
+    translations = final_translations(results, matches, norm_params)
+
+    # Results are independent, so check them in parallel. Only the fields needed
+    # for the check are sent to the workers, not the cached SDFs.
+    check_args = [
+        (
+            result.rotations,
+            final_translation,
+            result.mesh_path,
+            match.dataset_mesh_scale,
+        )
+        for result, match, final_translation in zip(results, matches, translations)
+    ]
+    with ProcessPoolExecutor(
+        max_workers=os.cpu_count(), initializer=_init_worker
+    ) as executor:
+        checked = list(executor.map(_check_one, check_args))
+
     # Process each result
-    for result in results:
-        filename, match = match_grasp_cache(result, cache)
+    for result, match, final_translation, outputs in zip(
+        results, matches, translations, checked
+    ):
+        has_collision, min_distance, is_graspable = outputs
 
         # Get training status
         is_used_in_training = match.mesh_path in used_files
 
-        translation = result.translations
         rotation = result.rotations
         mesh_path = result.mesh_path
         dataset_mesh_scale = match.dataset_mesh_scale
         centroid = match.centroid
 
-        # Denormalize and adjust translation with centroid
-        denormalized_translation = denormalize_translation(translation, norm_params)
-        final_translation = denormalized_translation + torch.tensor(
-            centroid, device=denormalized_translation.device
-        )
-
-        has_collision, scene, min_distance, is_graspable = check_collision(
-            rotation,
-            final_translation,
-            mesh_path,
-            dataset_mesh_scale,
-        )
-
         # Create entry for each grasp
         for i in range(len(rotation)):
             grasp_info = {
@@ -4,7 +4,6 @@ from collections import defaultdict
 from pathlib import Path
 
 import torch
-from einops import rearrange
 from torch.utils.data import DataLoader
 from tqdm import tqdm
 
@@ -83,7 +82,7 @@ if __name__ == "__main__":
         # Add to duplicate list
         duplicate_list.append(unique_id)
 
-        sdf_input = rearrange(grasp_data.sdf, "... -> 1 1 ...")
+        sdf_input = grasp_data.sdf[None, None]
 
         print("Sampling")
 
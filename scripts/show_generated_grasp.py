@@ -3,13 +3,19 @@ import json
 import os
 import pickle
 from dataclasses import dataclass
+from functools import lru_cache
 from pathlib import Path
 from typing import Tuple
 
 import torch
 
 from core.visualize import check_collision
-from data.data_manager import GraspCacheEntry
+from data.data_manager import (
+    CacheIndex,
+    GraspCache,
+    GraspCacheEntry,
+    index_grasp_cache,
+)
 from data.util import CPU_Unpickler, denormalize_translation
 from models.util import get_grasp_from_batch
 
@@ -24,22 +30,86 @@ class GraspResult:
     mesh_scale: float
 
 
+MESH_CACHE_FILENAME = ".mesh_cache.pkl"
+# Bumped when the layout of the persisted lookup changes
+MESH_CACHE_VERSION = 2
+
+
+def _mesh_dir_mtimes(meshes_dir: str) -> dict[str, float]:
+    """Modification times of the direct subdirectories of the mesh directory.
+
+    Meshes live in "meshes_dir/<category>/<object_id>.obj", so adding or removing a
+    mesh changes the mtime of one of these directories, and adding or removing a
+    category changes the keys. The mtime of meshes_dir itself is left out, as
+    writing the persisted lookup into it changes that.
+    """
+    mtimes = {}
+    with os.scandir(meshes_dir) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                mtimes[entry.path] = entry.stat().st_mtime
+    return mtimes
+
+
+def _scan_meshes(directory: str, mesh_cache: dict[str, list[Path]]) -> None:
+    """Recursively collect the .obj files of each object ID, in scan order."""
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                _scan_meshes(entry.path, mesh_cache)
+            elif entry.name.endswith(".obj"):
+                mesh_cache.setdefault(entry.name[:-4], []).append(Path(entry.path))
+
+
+@lru_cache(maxsize=None)
+def _build_mesh_cache(meshes_dir: str) -> dict[str, list[Path]]:
+    """Map object IDs to all their .obj files.
+
+    The lookup is persisted in meshes_dir/.mesh_cache.pkl and rebuilt when the
+    directory mtimes change. Persisting is skipped if the directory is read-only.
+    """
+    cache_path = os.path.join(meshes_dir, MESH_CACHE_FILENAME)
+    mtimes = _mesh_dir_mtimes(meshes_dir)
+
+    if os.path.exists(cache_path):
+        try:
+            with open(cache_path, "rb") as f:
+                cached = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            cached = {}
+        if cached.get("version") == MESH_CACHE_VERSION and cached["mtimes"] == mtimes:
+            return cached["meshes"]
+
+    mesh_cache: dict[str, list[Path]] = {}
+    _scan_meshes(meshes_dir, mesh_cache)
+
+    try:
+        with open(cache_path, "wb") as f:
+            pickle.dump(
+                {"version": MESH_CACHE_VERSION, "mtimes": mtimes, "meshes": mesh_cache},
+                f,
+            )
+    except OSError as e:
+        print(f"Could not write mesh cache {cache_path}: {e}")
+
+    return mesh_cache
+
+
 def find_mesh_path(object_id: str, meshes_dir: Path) -> Path:
     """Find the first matching .obj file for the given object ID."""
-    matches = list(meshes_dir.glob(f"**/{object_id}.obj"))
-    if not matches:
+    mesh_cache = _build_mesh_cache(str(meshes_dir))
+    if object_id not in mesh_cache:
         raise FileNotFoundError(f"No .obj file found for object_id: {object_id}")
-    return matches[0]
+    return mesh_cache[object_id][0]
 
 
 def load_grasp_results(grasp_dir: str, meshes_dir: str) -> list[GraspResult]:
     """Load grasp results from pickle files and match with their corresponding meshes."""
     grasp_path = Path(grasp_dir)
-    meshes_path = Path(meshes_dir)
     results = []
 
     # Build mesh lookup cache
-    mesh_cache = {path.stem: path for path in meshes_path.glob("**/*.obj")}
+    mesh_cache = _build_mesh_cache(str(meshes_dir))
 
     # Process pickle files
     for pkl_path in grasp_path.glob("*.pkl"):
@@ -54,7 +124,8 @@ def load_grasp_results(grasp_dir: str, meshes_dir: str) -> list[GraspResult]:
             data = pickle.load(f)
             results.append(
                 GraspResult(
-                    mesh_path=mesh_cache[object_id],
+                    # The last .obj found for the object, if it exists several times
+                    mesh_path=mesh_cache[object_id][-1],
                     rotations=data["so3_output"],
                     translations=data["r3_output"],
                     mesh_scale=float(mesh_scale),
@@ -65,37 +136,26 @@ def load_grasp_results(grasp_dir: str, meshes_dir: str) -> list[GraspResult]:
 
 
 def match_grasp_cache(
-    result: GraspResult, cache: dict[str, GraspCacheEntry]
+    result: GraspResult, index: CacheIndex
 ) -> Tuple[str, GraspCacheEntry]:
     """Find matching cache entry based on mesh name and normalization scale.
 
+    Args:
+        result: Grasp result to match
+        index: Cache index built with index_grasp_cache
+
     Raises:
-        ValueError: If multiple matching cache entries are found or if invalid cache filename
+        ValueError: If multiple matching cache entries are found
     """
     TOLERANCE = 1e-9
     item_name = result.mesh_path.parent.name
     item_id = result.mesh_path.stem
 
-    matches: list[Tuple[str, GraspCacheEntry]] = []
-
-    for filename, entry in cache.items():
-        if not filename.endswith(".h5"):
-            raise ValueError(f"Invalid cache filename: {filename}")
-
-        # Parse cache filename: "item_name_item_id_norm_params.h5"
-        parts = filename[:-3].split("_")  # Remove .h5 and split
-        cache_id = parts[-2]
-        cache_mesh_scale = float(parts[-1])
-        cache_name = "_".join(parts[:-2])  # Handle names with underscores
-
-        if item_name == cache_name and item_id == cache_id:
-            # print(f"Found matching cache entry: {filename}")
-            # print("Result mesh scale:", result.mesh_scale)
-            # print("Cache mesh scale:", cache_mesh_scale)
-
-            if abs(result.mesh_scale - cache_mesh_scale) < TOLERANCE:
-                # if str(entry.normalization_scale).startswith(f"{result.norm_scale:.3f}"):
-                matches.append((filename, entry))
+    matches: list[Tuple[str, GraspCacheEntry]] = [
+        (filename, entry)
+        for cache_mesh_scale, filename, entry in index.get((item_name, item_id), [])
+        if abs(result.mesh_scale - cache_mesh_scale) < TOLERANCE
+    ]
 
     if not matches:
         raise ValueError(f"No matching cache entry found for {item_name} {item_id}")
@@ -116,13 +176,14 @@ if __name__ == "__main__":
     # Load grasp results and cache
     results = load_grasp_results("grasp_results", "data/meshes")
 
-    with open("data/grasp_cache/grasp_cache.pkl", "rb") as f:
-        cache = pickle.load(f)
+    cache = GraspCache("data/grasp_cache").cache
 
     print(f"Loaded {len(cache)} cache entries")
 
+    cache_index = index_grasp_cache(cache)
+
     # # Example: Find cache match for first result
-    # match = match_grasp_cache(results[1], cache)
+    # match = match_grasp_cache(results[1], cache_index)
     # print(f"Found matching cache entry: {match is not None}")
 
     # ========================================
@@ -149,7 +210,7 @@ if __name__ == "__main__":
         # print("---")
 
         # ========================================
-        filename, match = match_grasp_cache(result, cache)
+        filename, match = match_grasp_cache(result, cache_index)
 
         # if match.mesh_path not in unused_files:
         # print(f"This file was used in training: {match.mesh_path}")
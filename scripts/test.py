@@ -4,7 +4,7 @@ from pathlib import Path
 
 import torch
 
-from data.data_manager import GraspCacheEntry
+from data.data_manager import GraspCache, GraspCacheEntry
 
 
 @dataclass
@@ -89,8 +89,7 @@ if __name__ == "__main__":
     # Load grasp results and cache
     results = load_grasp_results("grasp_results", "data/meshes")
 
-    with open("data/grasp_cache/grasp_cache.pkl", "rb") as f:
-        cache = pickle.load(f)
+    cache = GraspCache("data/grasp_cache").cache
 
     print(f"Loaded {len(cache)} cache entries")
 
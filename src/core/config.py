@@ -18,6 +18,8 @@ class MLPModelConfig:
     activation = torch.nn.ReLU
     num_hidden_layers: int = 3
     voxel_output_size: int = 256
+    sdf_cache_size: int = 128  # Encoded SDFs kept per mesh path, 0 disables the cache
+    compile: bool = False  # torch.compile the SDF encoder and the velocity MLP
 
     @classmethod
     def default(cls) -> "MLPModelConfig":
@@ -94,7 +96,8 @@ class TrainingConfig:
 
     # Training parameters
     max_epochs: int = 100
-    precision: Literal[16, 32, 64] = 32
+    # BF16 autocast for the SDF encoder and MLP, parameters and SO3 loss stay FP32
+    precision: Literal[16, 32, 64, "16-mixed", "bf16-mixed"] = "bf16-mixed"
     batch_accumulation: int = 1
     gradient_clip_val: float = 1.0
     r3_loss_weight: float = 3.0
@@ -109,6 +112,10 @@ class TrainingConfig:
     adamw_betas: tuple[float, float] = (0.9, 0.999)
     epsilon: float = 1e-8
     warmup_ratio: float = 0.1
+    # "one_cycle": warmup and linear decay with OneCycleLR, which also cycles AdamW's
+    # beta1 between 0.85 and 0.95. "linear": the same learning rates in closed form,
+    # keeping the configured betas
+    lr_schedule: Literal["one_cycle", "linear"] = "one_cycle"
 
     # Validation and Logging
     validation_interval: int = 0.1
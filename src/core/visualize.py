@@ -1,11 +1,13 @@
 import colorsys
 import random
-from typing import List, Tuple, Union
+from functools import lru_cache
+from typing import List, Optional, Tuple, Union
 
 import numpy as np
 import torch
 import trimesh
 import wandb
+from scipy.spatial import cKDTree
 from trimesh.collision import CollisionManager
 from trimesh.ray.ray_triangle import RayMeshIntersector
 
@@ -71,6 +73,112 @@ def create_parallel_gripper_mesh(
     return gripper_mesh
 
 
+def create_parallel_gripper_spheres(
+    sphere_spacing: float = 0.002,
+    gripper_width: float = 0.082,
+    gripper_height: float = 0.11217,
+    finger_thickness: float = 0.002,
+    base_height: float = 0.066,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Approximates the parallel-jaw gripper with spheres along its cylinder segments.
+
+    Returns:
+        Tuple containing:
+        - Sphere centers in the gripper frame [K, 3]
+        - Sphere radii [K]
+    """
+    half_width = gripper_width / 2
+
+    # Same segments as the cylinders of create_parallel_gripper_mesh
+    segments = np.array(
+        [
+            [[0, 0, 0], [0, 0, base_height]],
+            [[-half_width, 0, base_height], [half_width, 0, base_height]],
+            [[-half_width, 0, base_height], [-half_width, 0, gripper_height]],
+            [[half_width, 0, base_height], [half_width, 0, gripper_height]],
+        ]
+    )
+
+    centers = []
+    for start, end in segments:
+        num_spheres = int(np.ceil(np.linalg.norm(end - start) / sphere_spacing)) + 1
+        centers.append(np.linspace(start, end, num_spheres))
+    centers = np.concatenate(centers)
+
+    # Inflate the radius so the spheres also cover the cylinder between two centers
+    radius = np.sqrt(finger_thickness**2 + (sphere_spacing / 2) ** 2)
+    radii = np.full(len(centers), radius)
+
+    return centers, radii
+
+
+# Gripper primitives are pose independent, so build them once
+GRIPPER_SPHERE_CENTERS, GRIPPER_SPHERE_RADII = create_parallel_gripper_spheres()
+
+
+def voxel_downsample(points: np.ndarray, voxel_size: float) -> np.ndarray:
+    """Keeps the first point of every occupied voxel.
+
+    Voxel indices are packed into one int64 key (21 bits per axis), so the
+    deduplication is a 1D np.unique instead of a row-wise np.unique(axis=0).
+    """
+    voxel_indices = np.floor(points / voxel_size).astype(np.int64)
+    voxel_indices -= voxel_indices.min(axis=0)
+    assert voxel_indices.max() < 2**21, "Point cloud too large for voxel key packing"
+
+    keys = (
+        (voxel_indices[:, 0] << 42) | (voxel_indices[:, 1] << 21) | voxel_indices[:, 2]
+    )
+    _, first_indices = np.unique(keys, return_index=True)
+    return points[first_indices]
+
+
+def build_object_index(
+    object_mesh: trimesh.Trimesh,
+    surface_spacing: float = 0.001,
+) -> cKDTree:
+    """Builds a KD-tree over the vertices and dense surface samples of the object.
+
+    The surface is oversampled and then thinned to one point per half-spacing voxel,
+    which closes the gaps left by random sampling without growing the tree. The
+    number of samples scales with the surface area, so large objects are sampled
+    as densely as small ones.
+    """
+    num_samples = int(4 * object_mesh.area / surface_spacing**2)
+    samples, _ = trimesh.sample.sample_surface(object_mesh, num_samples, seed=0)
+    points = voxel_downsample(
+        np.concatenate([object_mesh.vertices, samples]), surface_spacing / 2
+    )
+    return cKDTree(points)
+
+
+# Object mesh with the collision structures built by load_object
+LoadedObject = Tuple[trimesh.Trimesh, cKDTree, CollisionManager]
+
+
+@lru_cache(maxsize=32)
+def load_object(object_mesh_path: str, mesh_scale: float) -> LoadedObject:
+    """Loads and scales the object mesh and builds its collision structures.
+
+    Cached per (path, scale) so repeated collision checks on the same object skip
+    the disk I/O, the surface sampling and the BVH construction.
+
+    Returns:
+        Tuple containing:
+        - Object mesh
+        - KD-tree of the object surface
+        - Collision manager holding the object
+    """
+    object_mesh = trimesh.load(object_mesh_path)
+    object_mesh.apply_scale(mesh_scale)
+    object_mesh = enforce_trimesh(object_mesh)
+
+    object_manager = CollisionManager()
+    object_manager.add_object("object", object_mesh)
+
+    return object_mesh, build_object_index(object_mesh), object_manager
+
+
 def create_grasp_volume(
     gripper_width: float = 0.082,
     gripper_height: float = 0.11217,
@@ -94,6 +202,11 @@ def create_grasp_volume(
     return grasp_box
 
 
+# Template meshes in the gripper frame, copied or transformed per grasp instead of rebuilt
+GRIPPER_MESH_TEMPLATE = create_parallel_gripper_mesh(color=[0, 255, 0])
+GRASP_VOLUME_TEMPLATE = create_grasp_volume()
+
+
 def find_contact_points(
     gripper_transform: np.ndarray,
     object_mesh: trimesh.Trimesh,
@@ -177,22 +290,52 @@ def check_collision(
     translation_vector: torch.Tensor,
     object_mesh_path: str,
     mesh_scale: float,
-) -> Tuple[List[bool], trimesh.Scene, List[float], List[bool]]:
-    """Checks for collisions between gripper poses and object using trimesh's CollisionManager.
+    compute_distance: bool = True,
+    return_scene: bool = True,
+    early_exit: bool = False,
+    workers: int = -1,
+    loaded_object: Optional[LoadedObject] = None,
+) -> Union[
+    Tuple[List[bool], Optional[trimesh.Scene], List[float], List[bool]],
+    Tuple[bool, None, float],
+]:
+    """Checks for collisions between gripper poses and object.
+
+    Gripper collisions and minimum distances are computed for all poses at once by
+    querying the sphere approximation of the gripper against a KD-tree of the object
+    surface. Grippers that do not cross the surface are tested for lying inside a
+    watertight object. Graspability is checked with trimesh's CollisionManager.
+
+    Args:
+        compute_distance: If False, the KD-tree search stops at the sphere radius.
+            Collision flags stay exact, but the minimum distance of collision-free
+            grasps is not resolved and reported as nan.
+        return_scene: If False, skip the gripper meshes, contact points and scene
+            that are only needed for visualization.
+        early_exit: If True, only report whether any grasp collides and skip the
+            per-grasp graspability checks and the scene.
+        workers: Threads of the KD-tree query, -1 for all cores. Use 1 when
+            checking in several processes.
+        loaded_object: The object as returned by load_object, for callers that
+            already hold it. Skips the lookup by object_mesh_path and mesh_scale.
 
     Returns:
         Tuple containing:
         - List of collision flags for each grasp
-        - Visualization scene
-        - List of minimum distances for each grasp
+        - Visualization scene, or None if return_scene is False
+        - List of minimum distances for each grasp: the clearance between the gripper
+          spheres and the sampled object surface, negative for colliding grasps.
+          Approximate to within the surface sampling spacing (about 1 mm).
         - List of graspability flags for each grasp
+        With early_exit, a tuple of (any grasp collides, None, minimum distance over
+        all grasps) instead.
     """
-    # Load and scale object mesh
-    object_mesh = trimesh.load(object_mesh_path)
-    if torch.is_tensor(mesh_scale):
-        mesh_scale = mesh_scale.cpu().numpy()
-    object_mesh.apply_scale(mesh_scale)
-    object_mesh = enforce_trimesh(object_mesh)
+    # Load and scale object mesh (cached across calls)
+    if loaded_object is None:
+        if torch.is_tensor(mesh_scale):
+            mesh_scale = mesh_scale.cpu().numpy()
+        loaded_object = load_object(object_mesh_path, float(mesh_scale))
+    object_mesh, object_index, object_manager = loaded_object
 
     # Check if rotation matrix is SO3 (3x3) or batched (Nx3x3)
     is_so3 = rotation_matrix.shape == torch.Size([3, 3])
@@ -214,30 +357,86 @@ def check_collision(
     batch_size = rotation_matrix.shape[0]
     gripper_meshes = []
     contact_spheres = []
-    collision_list = []
-    min_distance_list = []
     graspable_list = []
 
-    # Create collision manager for the object
-    object_manager = CollisionManager()
-    object_manager.add_object("object", object_mesh)
+    # Gripper transforms of all poses, transferred to the host once: [N, 4, 4].
+    # Converted to float64, numpy has no BF16
+    rotations = rotation_matrix.detach().to("cpu", torch.float64).numpy()
+    translations = translation_vector.detach().to("cpu", torch.float64).numpy()
+    gripper_transforms = np.tile(np.eye(4), (batch_size, 1, 1))
+    gripper_transforms[:, :3, :3] = rotations
+    gripper_transforms[:, :3, 3] = translations
+
+    # Transform the gripper spheres of all poses at once: [N, K, 3]
+    sphere_centers = (
+        np.einsum("nij,kj->nki", rotations, GRIPPER_SPHERE_CENTERS)
+        + translations[:, None, :]
+    )
+
+    # Single batched nearest neighbour query against the object surface.
+    # Without distances, only neighbours within the sphere radius matter.
+    distance_upper_bound = np.inf if compute_distance else GRIPPER_SPHERE_RADII.max()
+    distances, _ = object_index.query(
+        sphere_centers.reshape(-1, 3),
+        distance_upper_bound=distance_upper_bound,
+        workers=workers,
+    )
+    clearance = distances.reshape(batch_size, -1) - GRIPPER_SPHERE_RADII
+    min_clearance = clearance.min(axis=1)
+
+    # The surface distance is unsigned: a gripper that does not cross the surface
+    # may still be fully inside the object. The spheres form a connected chain, so
+    # testing one center per pose suffices. Only defined for watertight meshes.
+    free = np.flatnonzero(min_clearance >= 0)
+    if len(free) and object_mesh.is_watertight:
+        enclosed = free[object_mesh.contains(sphere_centers[free, 0])]
+        # Penetration depth of the deepest sphere, nan if not resolved
+        min_clearance[enclosed] = -(clearance[enclosed] + 2 * GRIPPER_SPHERE_RADII).max(
+            axis=1
+        )
+
+    collision_list = (min_clearance < 0).tolist()
+    min_distance_list = np.where(
+        np.isfinite(min_clearance), min_clearance, np.nan
+    ).tolist()
+
+    if early_exit:
+        overall_min_clearance = min_clearance.min()
+        return (
+            any(collision_list),
+            None,
+            float(overall_min_clearance)
+            if np.isfinite(overall_min_clearance)
+            else float("nan"),
+        )
+
+    # Collision manager for the grasp volume, moved to each grasp pose below
+    volume_manager = CollisionManager()
+    volume_manager.add_object("grasp_volume", GRASP_VOLUME_TEMPLATE)
 
     # Process each grasp
     for batch_idx in range(batch_size):
-        # Create transformation matrix
-        gripper_transform = torch.eye(4)
-        gripper_transform[:3, :3] = rotation_matrix[batch_idx]
-        gripper_transform[:3, 3] = translation_vector[batch_idx]
-        gripper_transform = gripper_transform.cpu().numpy()
+        gripper_transform = gripper_transforms[batch_idx]
+
+        # Place the grasp volume at the gripper pose
+        volume_manager.set_transform("grasp_volume", gripper_transform)
+
+        # Check graspability
+        has_collision = collision_list[batch_idx]
+        is_graspable, _, _ = object_manager.in_collision_other(
+            volume_manager, return_names=True, return_data=True
+        )
+
+        # Store results for this grasp
+        graspable_list.append(is_graspable)
+
+        if not return_scene:
+            continue
 
         # Create and transform gripper mesh
-        gripper_mesh = create_parallel_gripper_mesh(color=[0, 255, 0])
+        gripper_mesh = GRIPPER_MESH_TEMPLATE.copy()
         gripper_mesh.apply_transform(gripper_transform)
 
-        # Create and transform grasp volume mesh
-        grasp_volume = create_grasp_volume()
-        grasp_volume.apply_transform(gripper_transform)
-
         # Find contact points with increased density
         left_contacts = find_contact_points(
             gripper_transform,
@@ -257,31 +456,6 @@ def check_collision(
             contact_sphere.visual.face_colors = color
             contact_spheres.append(contact_sphere)
 
-        # Create collision managers
-        gripper_manager = CollisionManager()
-        gripper_manager.add_object("gripper", gripper_mesh)
-
-        volume_manager = CollisionManager()
-        volume_manager.add_object("grasp_volume", grasp_volume)
-
-        # Check collisions and update visualization
-        has_collision, _, _ = object_manager.in_collision_other(
-            gripper_manager, return_names=True, return_data=True
-        )
-
-        is_graspable, _, _ = object_manager.in_collision_other(
-            volume_manager, return_names=True, return_data=True
-        )
-
-        min_distance, _, _ = object_manager.min_distance_other(
-            gripper_manager, return_names=True, return_data=True
-        )
-
-        # Store results for this grasp
-        collision_list.append(has_collision)
-        min_distance_list.append(min_distance)
-        graspable_list.append(is_graspable)
-
         # Update gripper color based on grasp evaluation
         if has_collision:
             color = [255, 0, 0]  # Red
@@ -293,14 +467,12 @@ def check_collision(
         gripper_mesh.visual.face_colors = color
         gripper_meshes.append(gripper_mesh)
 
-    # Create visualization
-    if isinstance(object_mesh, trimesh.Scene):
-        scene = object_mesh
-        for mesh in gripper_meshes + contact_spheres:
-            scene.add_geometry(mesh)
-    else:
-        all_meshes = [object_mesh] + gripper_meshes + contact_spheres
-        scene = trimesh.Scene(all_meshes)
+    if not return_scene:
+        return collision_list, None, min_distance_list, graspable_list
+
+    # Create visualization, copying the cached object so the scene owns its geometry
+    all_meshes = [object_mesh.copy()] + gripper_meshes + contact_spheres
+    scene = trimesh.Scene(all_meshes)
 
     return collision_list, scene, min_distance_list, graspable_list
 
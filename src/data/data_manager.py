@@ -1,6 +1,7 @@
 import logging
 import os
 import pickle
+from collections import defaultdict
 from dataclasses import dataclass
 from pathlib import Path
 from typing import Optional, Tuple
@@ -27,6 +28,33 @@ class GraspCacheEntry:
     centroid: np.ndarray
 
 
+# Cache entries grouped by (item_name, item_id), as (mesh_scale, filename, entry)
+CacheIndex = dict[Tuple[str, str], list[Tuple[float, str, GraspCacheEntry]]]
+
+
+def index_grasp_cache(cache: dict[str, GraspCacheEntry]) -> CacheIndex:
+    """Parse all cache filenames once and group the entries by (item_name, item_id).
+
+    Raises:
+        ValueError: If invalid cache filename
+    """
+    index: CacheIndex = defaultdict(list)
+
+    for filename, entry in cache.items():
+        if not filename.endswith(".h5"):
+            raise ValueError(f"Invalid cache filename: {filename}")
+
+        # Parse cache filename: "item_name_item_id_norm_params.h5"
+        parts = filename[:-3].split("_")  # Remove .h5 and split
+        cache_id = parts[-2]
+        cache_mesh_scale = float(parts[-1])
+        cache_name = "_".join(parts[:-2])  # Handle names with underscores
+
+        index[(cache_name, cache_id)].append((cache_mesh_scale, filename, entry))
+
+    return index
+
+
 class GraspCache:
     """Cache for processed grasp data."""
 
@@ -34,23 +62,66 @@ class GraspCache:
         self.cache_dir = Path(cache_dir)
         self.cache_dir.mkdir(parents=True, exist_ok=True)
         self.cache_file = self.cache_dir / "grasp_cache.pkl"
+        # Raw numpy data of the cache, pickled out-of-band and memory-mapped on load
+        self.buffers_file = self.cache_dir / "grasp_cache_buffers.npy"
         self.cache: dict[str, GraspCacheEntry] = {}
         self._load()
 
     def _load(self):
-        """Load entire cache from pickle once. (Main process only)"""
+        """Load entire cache from pickle once. (Main process only)
+
+        The pickle file starts with the (start, stop) byte spans of the out-of-band
+        buffers, followed by the cache itself. Arrays are read-only views into the
+        memory-mapped buffers file, so nothing is copied until it is accessed.
+        Caches written as a single in-band pickle are still supported.
+        """
         if self.cache_file.exists():
             try:
                 with open(self.cache_file, "rb") as f:
-                    self.cache = pickle.load(f)
+                    header = pickle.load(f)
+                    if isinstance(header, dict):
+                        self.cache = header
+                        return
+
+                    buffers = np.load(self.buffers_file, mmap_mode="r")
+                    self.cache = pickle.load(
+                        f, buffers=[buffers[start:stop] for start, stop in header]
+                    )
             except Exception as e:
                 logger.warning(f"Failed to load cache: {e}. Starting empty cache.")
 
     def _save(self):
         """Write entire cache dict to pickle once. (Main process only)"""
         try:
-            with open(self.cache_file, "wb") as f:
-                pickle.dump(self.cache, f)
+            buffers: list[pickle.PickleBuffer] = []
+            data = pickle.dumps(self.cache, protocol=5, buffer_callback=buffers.append)
+
+            # Lay out the buffers back to back, aligned to 64 bytes
+            spans = []
+            offset = 0
+            for buffer in buffers:
+                start = -(-offset // 64) * 64
+                offset = start + buffer.raw().nbytes
+                spans.append((start, offset))
+
+            # Write to temporary files first: the current cache may still be
+            # memory-mapped from the files being replaced
+            buffers_tmp = self.buffers_file.with_name(self.buffers_file.name + ".tmp")
+            mapped = np.lib.format.open_memmap(
+                buffers_tmp, mode="w+", dtype=np.uint8, shape=(offset,)
+            )
+            for buffer, (start, stop) in zip(buffers, spans):
+                mapped[start:stop] = np.frombuffer(buffer.raw(), dtype=np.uint8)
+            mapped.flush()
+            del mapped
+
+            cache_tmp = self.cache_file.with_name(self.cache_file.name + ".tmp")
+            with open(cache_tmp, "wb") as f:
+                pickle.dump(spans, f)
+                f.write(data)
+
+            os.replace(buffers_tmp, self.buffers_file)
+            os.replace(cache_tmp, self.cache_file)
         except Exception as e:
             logger.error(f"Failed to save cache: {e}")
 
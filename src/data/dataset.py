@@ -1,3 +1,4 @@
+import bisect
 import concurrent.futures
 import json
 import logging
@@ -220,11 +221,10 @@ class GraspDataset(Dataset):
         if self.selected_indices is not None:
             idx = self.selected_indices[idx]
 
-        # Find which grasp file contains this index
-        entry_match = next(
-            (entry for entry in self.grasp_entries if entry[1] <= idx < entry[2])
-        )
-        filename, start_idx, _ = entry_match
+        # Find which grasp file contains this index. Entries are contiguous and
+        # ordered by start index, so the last one starting at or before idx
+        entry_pos = bisect.bisect_right(self.grasp_entries, idx, key=lambda e: e[1])
+        filename, start_idx, _ = self.grasp_entries[entry_pos - 1]
         entry = self.cache.cache[filename]
         grasp_idx = idx - start_idx
 
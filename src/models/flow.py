@@ -1,8 +1,7 @@
+import math
 from typing import Optional, Tuple
 
 import torch
-from geomstats.geometry.special_orthogonal import SpecialOrthogonal
-from scipy.spatial.transform import Rotation
 from torch import Tensor
 
 from src.models.velocity_mlp import VelocityNetwork
@@ -19,7 +18,8 @@ basis = torch.tensor(
 def rotmat_to_rotvec(matrix):
     """
     Convert rotation matrices to rotation vectors (axis-angle representation).
-    This combines the previous quaternion conversion and vector conversion steps.
+    Uses the closed-form axis-angle formula on the whole batch, with a Taylor
+    expansion for small angles and the symmetric part for angles close to pi.
 
     Args:
         matrix: Batch of 3x3 rotation matrices
@@ -29,65 +29,48 @@ def rotmat_to_rotvec(matrix):
     if len(matrix.shape) != 3 or matrix.shape[-1] != 3 or matrix.shape[-2] != 3:
         raise ValueError("Input has to be a batch of 3x3 Tensors.")
 
-    # Step 1: Convert rotation matrix to quaternion
+    # Only the conversion runs in float64, the result keeps the input dtype
+    dtype = matrix.dtype
     matrix = matrix.to(torch.float64)
-    num_rots = matrix.shape[0]
-
-    # Calculate diagonal and trace for quaternion conversion
-    matrix_diag = torch.diagonal(matrix, dim1=-2, dim2=-1)
-    matrix_trace = torch.sum(matrix_diag, dim=-1, keepdim=True)
-    decision = torch.cat((matrix_diag, matrix_trace), dim=-1)
-    choice = torch.argmax(decision, dim=-1)
-
-    # Initialize quaternion output
-    quat = torch.zeros((num_rots, 4), dtype=matrix.dtype, device=matrix.device)
-
-    # Handle case where choice is not trace (not 3)
-    not_three_mask = choice != 3
-    i = choice[not_three_mask]
-    j = (i + 1) % 3
-    k = (j + 1) % 3
-
-    quat[not_three_mask, i] = (
-        1 - decision[not_three_mask, 3] + 2 * matrix[not_three_mask, i, i]
-    ).to(torch.float64)
-    quat[not_three_mask, j] = (
-        matrix[not_three_mask, j, i] + matrix[not_three_mask, i, j]
-    ).to(torch.float64)
-    quat[not_three_mask, k] = (
-        matrix[not_three_mask, k, i] + matrix[not_three_mask, i, k]
-    ).to(torch.float64)
-    quat[not_three_mask, 3] = (
-        matrix[not_three_mask, k, j] - matrix[not_three_mask, j, k]
-    ).to(torch.float64)
-
-    # Handle case where choice is trace (3)
-    three_mask = ~not_three_mask
-    quat[three_mask, 0] = (matrix[three_mask, 2, 1] - matrix[three_mask, 1, 2]).to(
-        torch.float64
-    )
-    quat[three_mask, 1] = (matrix[three_mask, 0, 2] - matrix[three_mask, 2, 0]).to(
-        torch.float64
-    )
-    quat[three_mask, 2] = (matrix[three_mask, 1, 0] - matrix[three_mask, 0, 1]).to(
-        torch.float64
-    )
-    quat[three_mask, 3] = (1 + decision[three_mask, 3]).to(torch.float64)
-
-    # Normalize quaternion
-    quat = quat / torch.norm(quat, dim=-1, keepdim=True)
 
-    # Step 2: Convert quaternion to rotation vector
-    quat = torch.where(quat[..., 3:4] < 0, -quat, quat)
-    angle = 2.0 * torch.atan2(torch.norm(quat[..., :3], dim=-1), quat[..., 3])
+    # Skew-symmetric part gives the axis scaled by 2 * sin(angle)
+    axis = torch.stack(
+        [
+            matrix[..., 2, 1] - matrix[..., 1, 2],
+            matrix[..., 0, 2] - matrix[..., 2, 0],
+            matrix[..., 1, 0] - matrix[..., 0, 1],
+        ],
+        dim=-1,
+    )
+    two_sin = torch.norm(axis, dim=-1)
+    trace = torch.diagonal(matrix, dim1=-2, dim2=-1).sum(dim=-1)
+    cos = (trace - 1) / 2
+    angle = torch.atan2(two_sin / 2, cos)
     angle2 = angle * angle
 
     # Handle small and large angles differently
-    small_scale = 2 + angle2 / 12 + 7 * angle2 * angle2 / 2880
-    large_scale = angle / torch.sin(angle / 2 + 1e-6)
+    small_scale = 0.5 + angle2 / 12 + 7 * angle2 * angle2 / 720
+    large_scale = angle / two_sin.clamp_min(1e-12)
     scale = torch.where(angle <= 1e-3, small_scale, large_scale)
+    rotvec = scale[..., None] * axis
+
+    # Close to pi the skew-symmetric part vanishes, recover the axis from
+    # (R + R^T) / 2 - cos(angle) * I = (1 - cos(angle)) * axis * axis^T instead
+    symmetric = 0.5 * (matrix + matrix.transpose(-2, -1))
+    symmetric = symmetric - cos[..., None, None] * torch.eye(
+        3, dtype=matrix.dtype, device=matrix.device
+    )
+    column = torch.argmax(torch.diagonal(symmetric, dim1=-2, dim2=-1), dim=-1)
+    pi_axis = torch.gather(
+        symmetric, -1, column[..., None, None].expand(*column.shape, 3, 1)
+    ).squeeze(-1)
+    pi_axis = pi_axis / torch.norm(pi_axis, dim=-1, keepdim=True).clamp_min(1e-12)
+    pi_axis = torch.where((pi_axis * axis).sum(-1, keepdim=True) < 0, -pi_axis, pi_axis)
 
-    return scale[..., None] * quat[..., :3]
+    near_pi = angle > math.pi - 1e-2
+    rotvec = torch.where(near_pi[..., None], angle[..., None] * pi_axis, rotvec)
+
+    return rotvec.to(dtype)
 
 
 # hat map from vector space R^3 to Lie algebra so(3)
@@ -118,36 +101,15 @@ def sample_location_and_conditional_flow(x0, x1, t):
         xt: Interpolated rotation matrices at time t
         ut: Velocity field at time t (tangent vectors)
     """
-    vec_manifold = SpecialOrthogonal(n=3, point_type="vector")
-
-    # Convert rotations to axis-angle representation and compute log map
-    rot_x0 = rotmat_to_rotvec(x0)
-    rot_x1 = rotmat_to_rotvec(x1)
-
-    # Ensure t requires gradient for velocity computation
-    t.requires_grad = True
-
-    log_x1 = vec_manifold.log_not_from_identity(rot_x1, rot_x0)
+    # Log map of x1 at x0, expressed in the Lie algebra: hat(Log(x0^T @ x1))
+    delta_x1 = torch.transpose(x0, dim0=-2, dim1=-1) @ x1.to(x0.dtype)
+    skew = batch_vector_to_skew_symmetric(rotmat_to_rotvec(delta_x1))
 
-    # Compute interpolated rotation at time t
-    xt = vec_manifold.exp_not_from_identity(t.reshape(-1, 1) * log_x1, rot_x0)
-    xt = vec_manifold.matrix_from_rotation_vector(xt)
-    epsilon = 1e-6
-    delta_r = torch.transpose(x0, dim0=-2, dim1=-1) @ xt
-    ut = xt @ log(delta_r) / (t[:, None, None] + epsilon)
+    # Geodesic interpolation xt = x0 @ exp(t * hat(w))
+    xt = x0 @ torch.linalg.matrix_exp(t.reshape(-1, 1, 1).to(x0.dtype) * skew)
 
-    # # Compute velocity field using automatic differentiation
-    # xt_flat = rearrange(xt, "b c d -> b (c d)", c=3, d=3)
-
-    # def index_time_der(i):
-    #     return torch.autograd.grad(xt_flat, t, i, create_graph=True, retain_graph=True)[
-    #         0
-    #     ]
-    # xt_dot = vmap(index_time_der, in_dims=1)(
-    #     torch.eye(9).to(xt.device).repeat(xt_flat.shape[0], 1, 1)
-    # )
-
-    # ut = rearrange(xt_dot, "(c d) b -> b c d", c=3, d=3)
+    # Its time derivative is the left-invariant tangent xt @ hat(w)
+    ut = torch.einsum("bij,bjk->bik", xt, skew)
 
     return xt, ut
 
@@ -175,24 +137,64 @@ def inference_step(
     Returns:
         Tuple of (next_so3_state, next_r3_state)
     """
-    # Get velocities - model now expects [batch, 3, 3] input
+    # Get velocities - SO3 velocity in the body frame, i.e. skew-symmetric [batch, 3, 3]
     so3_velocity, r3_velocity = model(
-        so3_state, r3_state, sdf_input, t, normalization_scale, sdf_path
+        so3_state,
+        r3_state,
+        sdf_input,
+        t,
+        normalization_scale,
+        sdf_path,
+        body_frame=True,
     )
 
+    # Integrate in the precision of the state, also when the model ran under autocast
+    step = compiled_integrate_step if model.compiled else integrate_step
+    with torch.autocast(so3_state.device.type, enabled=False):
+        return step(
+            so3_state,
+            r3_state,
+            so3_velocity.to(so3_state.dtype),
+            r3_velocity.to(r3_state.dtype),
+            dt,
+        )
+
+
+def integrate_step(
+    so3_state: Tensor,
+    r3_state: Tensor,
+    so3_velocity: Tensor,
+    r3_velocity: Tensor,
+    dt: Tensor,
+) -> Tuple[Tensor, Tensor]:
+    """Euler step on R3 and geodesic step on SO3.
+
+    Args:
+        so3_state: Current SO3 state [batch, 3, 3]
+        r3_state: Current R3 state [batch, 3]
+        so3_velocity: Body-frame SO3 velocity, skew-symmetric [batch, 3, 3]
+        r3_velocity: R3 velocity [batch, 3]
+        dt: Time step size [1]
+
+    Returns:
+        Tuple of (next_so3_state, next_r3_state)
+    """
     # R3 update remains the same
     r3_next = r3_state + dt * r3_velocity
 
-    # SO3 update with exponential map
-    # so3_velocity is already in [batch, 3, 3] format
-    skew_sym = torch.einsum("...ij,...ik->...jk", so3_state, so3_velocity * dt)
-    so3_next = torch.einsum(
-        "...ij,...jk->...ik", so3_state, torch.linalg.matrix_exp(skew_sym)
-    )
+    # SO3 update with exponential map, no need to pull the velocity back with R^T
+    so3_next = so3_state @ skew_symmetric_exp(so3_velocity * dt)
 
     return so3_next, r3_next
 
 
+# Used for models compiled with MLPModelConfig.compile. Shapes are fixed for the
+# whole sampling loop, so specialize on them (no guards). The model call stays
+# outside: its SDF cache is keyed on sdf_path strings, which would make dynamo
+# recompile for every new object.
+compiled_integrate_step = torch.compile(integrate_step, dynamic=False)
+
+
 @torch.no_grad()
 def sample(
     model: VelocityNetwork,
@@ -216,37 +218,108 @@ def sample(
             so3_samples: [num_samples, 3, 3]
             r3_samples: [num_samples, 3]
     """
-    # Initialize random starting points - already in correct shape
-    so3_traj = torch.tensor(
-        Rotation.random(num_samples).as_matrix(), dtype=torch.float64
-    ).to(device)  # Shape: [num_samples, 3, 3]
+    # Integrate in the precision of the model (float32 unless trained otherwise).
+    # Sampling is also called from steps running under mixed precision autocast,
+    # which would round the rotations to BF16 over the integration
+    dtype = next(model.parameters()).dtype
+
+    # Initialize random starting points directly on the device
+    so3_traj = random_rotation_matrices(num_samples, device, dtype)
+    # Shape: [num_samples, 3, 3]
 
-    r3_traj = torch.randn(num_samples, 3, dtype=torch.float64).to(device)
+    r3_traj = torch.randn(num_samples, 3, dtype=dtype, device=device)
 
     # Setup time steps
-    t = torch.linspace(0, 1, steps).to(device)
-    dt = torch.tensor([1 / steps]).to(device)
+    t = torch.linspace(0, 1, steps, dtype=dtype).to(device)
+    dt = torch.tensor([1 / steps], dtype=dtype).to(device)
 
     # Generate trajectories
-    for t_i in t:
-        t_batch = (
-            torch.tensor([t_i], dtype=torch.float64).repeat(num_samples).to(device)
-        )
-        so3_traj, r3_traj = inference_step(
-            model,
-            so3_traj,
-            r3_traj,
-            sdf_input,
-            normalization_scale,
-            t_batch,
-            dt,
-            sdf_path,
-        )
+    with torch.autocast(so3_traj.device.type, enabled=False):
+        for t_i in t:
+            t_batch = t_i.repeat(num_samples)
+            so3_traj, r3_traj = inference_step(
+                model,
+                so3_traj,
+                r3_traj,
+                sdf_input,
+                normalization_scale,
+                t_batch,
+                dt,
+                sdf_path,
+            )
 
     # No need to reshape SO3 output as it's already in the correct shape
     return so3_traj, r3_traj
 
 
+def random_rotation_matrices(
+    num_samples: int,
+    device: Optional[torch.device] = None,
+    dtype: torch.dtype = torch.float32,
+) -> Tensor:
+    """
+    Sample uniformly distributed rotation matrices on the given device.
+    Normalized Gaussian quaternions are uniform on SO(3), so no CPU sampling
+    or host to device copy is needed.
+
+    Args:
+        num_samples: Number of rotations to sample
+        device: Device to sample on
+        dtype: Data type of the rotations
+
+    Returns:
+        A tensor of rotation matrices of shape (num_samples, 3, 3)
+    """
+    quat = torch.randn(num_samples, 4, device=device, dtype=dtype)
+    quat = quat / torch.norm(quat, dim=-1, keepdim=True)
+    w, x, y, z = quat.unbind(dim=-1)
+
+    matrix = torch.stack(
+        [
+            1 - 2 * (y * y + z * z),
+            2 * (x * y - z * w),
+            2 * (x * z + y * w),
+            2 * (x * y + z * w),
+            1 - 2 * (x * x + z * z),
+            2 * (y * z - x * w),
+            2 * (x * z - y * w),
+            2 * (y * z + x * w),
+            1 - 2 * (x * x + y * y),
+        ],
+        dim=-1,
+    )
+
+    return matrix.reshape(num_samples, 3, 3)
+
+
+def skew_symmetric_exp(skew: Tensor) -> Tensor:
+    """
+    Exponential map of a batch of 3x3 skew-symmetric matrices with Rodrigues' formula
+    exp(K) = I + sin(theta) / theta * K + (1 - cos(theta)) / theta^2 * K^2.
+    This replaces the generic Pade approximation of torch.linalg.matrix_exp.
+
+    Args:
+        skew: Skew-symmetric matrices of shape (..., 3, 3)
+
+    Returns:
+        Rotation matrices of shape (..., 3, 3)
+    """
+    omega = torch.stack([skew[..., 2, 1], skew[..., 0, 2], skew[..., 1, 0]], dim=-1)
+    theta = torch.norm(omega, dim=-1)[..., None, None]
+    theta2 = theta * theta
+
+    # Taylor expansion around zero, the closed form elsewhere.
+    # (1 - cos(theta)) is written as 2 * sin^2(theta / 2) to avoid cancellation.
+    small = theta < 1e-4
+    safe_theta = torch.where(small, torch.ones_like(theta), theta)
+    sin_coeff = torch.where(small, 1 - theta2 / 6, torch.sin(safe_theta) / safe_theta)
+    half_sinc = torch.sin(safe_theta / 2) / (safe_theta / 2)
+    cos_coeff = torch.where(small, 0.5 - theta2 / 24, 0.5 * half_sinc * half_sinc)
+
+    eye = torch.eye(3, dtype=skew.dtype, device=skew.device)
+    return eye + sin_coeff * skew + cos_coeff * (skew @ skew)
+
+
 def batch_vector_to_skew_symmetric(v: torch.Tensor) -> torch.Tensor:
     """
     Create skew-symmetric matrices from a batch of 3D vectors.
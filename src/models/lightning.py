@@ -1,21 +1,42 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
 from typing import Dict, Optional, Tuple
 
 import pytorch_lightning as pl
 import torch
-import torch.nn.functional as F
 import wandb
-from einops import rearrange
-from scipy.spatial.transform import Rotation
 from torch import Tensor
 
 from src.core.config import ExperimentConfig
-from src.core.visualize import check_collision, scene_to_wandb_3d
+from src.core.visualize import LoadedObject, check_collision, scene_to_wandb_3d
 from src.data.util import GraspData, denormalize_translation
-from src.models.flow import sample, sample_location_and_conditional_flow
+from src.models.flow import (
+    random_rotation_matrices,
+    sample,
+    sample_location_and_conditional_flow,
+)
 from src.models.util import get_grasp_from_batch
 from src.models.velocity_mlp import VelocityNetwork
 
 
+def linear_warmup_decay(
+    step: int, total_steps: int, warmup_ratio: float, div_factor: float
+) -> float:
+    """Learning rate factor of a linear warmup from 1 / div_factor to 1, followed by
+    a linear decay to 0 at the last step, and 0 after it.
+
+    Matches the learning rates of OneCycleLR with anneal_strategy="linear" and
+    final_div_factor=inf.
+    """
+    warmup_end = warmup_ratio * total_steps - 1
+    if step <= warmup_end:
+        start, end, pct = 1 / div_factor, 1.0, step / warmup_end
+    else:
+        start, end = 1.0, 0.0
+        pct = (step - warmup_end) / (total_steps - 1 - warmup_end)
+    return max(start + (end - start) * pct, 0.0)
+
+
 class Lightning(pl.LightningModule):
     """Flow Matching model combining SO3 and R3 manifold learning with synchronized time sampling."""
 
@@ -23,10 +44,75 @@ class Lightning(pl.LightningModule):
         super().__init__()
         self.config = config
         self.model = VelocityNetwork(self.config)
+        # Generator for the time and noise samples of the loss, created on its device
+        self._gen: Optional[torch.Generator] = None
+        # Per mesh tensors for sampling and scenes, keyed by (mesh_path, dataset_mesh_scale).
+        # Normalization scales are kept in the model dtype, so every integration step
+        # uses them without a conversion
+        self._centroid_cache: Dict[Tuple[str, float], Tensor] = {}
+        self._normalization_scale_cache: Dict[Tuple[str, float], Tensor] = {}
+        # Background thread building and logging generated grasp scenes during training
+        self._log_executor: Optional[ThreadPoolExecutor] = None
+        self._log_future: Optional[Future] = None
 
         # TODO use config
         self.save_hyperparameters()
 
+    def generator(self, device: torch.device) -> torch.Generator:
+        """Get the loss sampling generator on the given device.
+
+        It is seeded from the global RNG, so seed_everything still applies.
+        """
+        if self._gen is None or self._gen.device != device:
+            seed = int(torch.randint(2**62, (1,)))
+            self._gen = torch.Generator(device=device)
+            self._gen.manual_seed(seed)
+        return self._gen
+
+    def mesh_tensor(
+        self,
+        cache: Dict[Tuple[str, float], Tensor],
+        grasp_data: GraspData,
+        value,
+        dtype: Optional[torch.dtype] = None,
+    ) -> Tensor:
+        """Get a per mesh value of grasp_data as a tensor on the module's device.
+
+        Values read from the dataset are converted once per mesh and cached, values of
+        a collated batch are already tensors and only moved if needed.
+
+        Args:
+            dtype: dtype of the tensor, by default that of value
+        """
+        if isinstance(value, Tensor):
+            return value.to(self.device, dtype)
+        key = (grasp_data.mesh_path, float(grasp_data.dataset_mesh_scale))
+        tensor = cache.get(key)
+        if (
+            tensor is None
+            or tensor.device != self.device
+            or (dtype is not None and tensor.dtype != dtype)
+        ):
+            tensor = torch.as_tensor(value, dtype=dtype, device=self.device)
+            cache[key] = tensor
+        return tensor
+
+    def draw_loss_samples(
+        self, so3_inputs: Tensor, r3_inputs: Tensor
+    ) -> Tuple[Tensor, Tensor, Tensor]:
+        """Draw the flow time, SO3 starting points and R3 noise of a batch.
+
+        Returns:
+            Tuple of (t [batch], x0_so3 [batch, 3, 3], noise [batch, 3])
+        """
+        gen = self.generator(r3_inputs.device)
+        t = torch.rand(r3_inputs.size(0), device=r3_inputs.device, generator=gen)
+        x0_so3 = random_rotation_matrices(
+            r3_inputs.size(0), r3_inputs.device, so3_inputs.dtype
+        )
+        noise = torch.empty_like(r3_inputs).normal_(generator=gen)
+        return t, x0_so3, noise
+
     def compute_loss(
         self,
         so3_inputs: Tensor,
@@ -49,47 +135,65 @@ class Lightning(pl.LightningModule):
         """
         # Sample synchronized time points for both manifolds
 
-        so3_inputs = self.model.duplicate_to_batch_size(
-            so3_inputs,
+        # Duplicate small batches by gathering with one shared index, so each
+        # duplicated pose keeps its own SDF and normalization scale. The SDFs are
+        # not duplicated, their encoded features are gathered in the model
+        batch_index = self.model.duplicate_indices(
+            so3_inputs.size(0),
             self.config.data.batch_size,
             self.config.training.duplicate_ratio,
+            so3_inputs.device,
         )
-        r3_inputs = self.model.duplicate_to_batch_size(
-            r3_inputs, self.config.data.batch_size, self.config.training.duplicate_ratio
-        )
-        t = torch.rand(r3_inputs.size(0), device=so3_inputs.device)
-
-        # SO3 computation - already in [batch, 3, 3] format
-        x0_so3 = torch.tensor(
-            Rotation.random(r3_inputs.size(0)).as_matrix(), device=so3_inputs.device
-        )  # Shape: [batch, 3, 3]
-
-        # Sample location and flow for SO
-        xt_so3, ut_so3 = sample_location_and_conditional_flow(x0_so3, so3_inputs, t)
-        # Both xt_so3 and ut_so3 are [batch, 3, 3]
+        if batch_index is not None:
+            so3_inputs = so3_inputs.index_select(0, batch_index)
+            r3_inputs = r3_inputs.index_select(0, batch_index)
+        # The SO3 geodesics are sensitive to rounding near the identity, so under
+        # mixed precision training only the model runs in reduced precision
+        with torch.autocast(so3_inputs.device.type, enabled=False):
+            # Time [batch], SO3 starting points [batch, 3, 3] and R3 noise [batch, 3]
+            t, x0_so3, noise = self.draw_loss_samples(so3_inputs, r3_inputs)
+
+            # Sample location and flow for SO
+            xt_so3, ut_so3 = sample_location_and_conditional_flow(x0_so3, so3_inputs, t)
+            # Both xt_so3 and ut_so3 are [batch, 3, 3]
 
         t_expanded = t.unsqueeze(-1)  # [batch, 1]
-        noise = torch.randn_like(r3_inputs)
 
-        # Get predicted flow for R3
-        x_t_r3 = (
-            1 - (1 - self.config.model.sigma_min) * t_expanded
-        ) * noise + t_expanded * r3_inputs
+        # Get predicted flow for R3:
+        # (1 - (1 - sigma_min) t) noise + t x1 = lerp(noise, x1, t) + sigma_min t noise
+        weight = t_expanded.to(r3_inputs.dtype)
+        x_t_r3 = torch.lerp(noise, r3_inputs, weight).addcmul_(
+            weight, noise, value=self.config.model.sigma_min
+        )
 
         # Forward pass now expects [batch, 3, 3] format
         vt_so3, predicted_flow = self.model.forward(
-            xt_so3, x_t_r3, sdf_inputs, t_expanded, normalization_scale, sdf_path
+            xt_so3,
+            x_t_r3,
+            sdf_inputs,
+            t_expanded,
+            normalization_scale,
+            sdf_path,
+            batch_index=batch_index,
         )
         # vt_so3 is now directly [batch, 3, 3]
 
-        # Compute SO3 loss using Riemannian metric
-        r = torch.transpose(xt_so3, dim0=-2, dim1=-1) @ (vt_so3 - ut_so3)
-        norm = -torch.diagonal(r @ r, dim1=-2, dim2=-1).sum(dim=-1) / 2
-        so3_loss = torch.mean(norm, dim=-1)
-
-        # Compute noisy sample and optimal flow for R3
-        optimal_flow = r3_inputs - (1 - self.config.model.sigma_min) * noise
-        r3_loss = F.mse_loss(predicted_flow, optimal_flow)
+        # Compute SO3 loss using Riemannian metric -tr(r r) / 2, r = xt^T (vt - ut).
+        # tr(r r) = sum_ij r_ij r_ji, so only the trace is computed, not r @ r.
+        # Like the flow, computed in full precision from the upcast prediction
+        with torch.autocast(xt_so3.device.type, enabled=False):
+            r = torch.einsum("bji,bjk->bik", xt_so3, vt_so3.to(ut_so3.dtype) - ut_so3)
+            so3_loss = torch.mean(-0.5 * torch.einsum("bij,bji->b", r, r), dim=-1)
+
+        # MSE to the optimal flow for R3, x1 - (1 - sigma_min) noise, in one expression
+        r3_loss = torch.mean(
+            (
+                predicted_flow.to(r3_inputs.dtype)
+                - r3_inputs
+                + (1 - self.config.model.sigma_min) * noise
+            )
+            ** 2
+        )
 
         # Works better in this setup but we can change later
         total_loss = (
@@ -122,45 +226,82 @@ class Lightning(pl.LightningModule):
             prog_bar=True,
             batch_size=self.config.data.batch_size,
         )
-        if (batch_idx % self.config.training.sample_interval == 0) and (
-            batch_idx // self.config.training.sample_interval >= 1
+        # Only sampled on rank zero, the other ranks would log the same thing
+        if (
+            self.trainer.is_global_zero
+            and (batch_idx % self.config.training.sample_interval == 0)
+            and (batch_idx // self.config.training.sample_interval >= 1)
         ):
-            random_idx = torch.randint(
-                0, len(self.trainer.train_dataloader.dataset), (1,)
+            # A Python int, so the (Subset) dataset indexes its lists directly
+            random_idx = int(
+                torch.randint(0, len(self.trainer.train_dataloader.dataset), (1,))
             )
             grasp_data = self.trainer.train_dataloader.dataset[random_idx]
 
-            sdf_input = rearrange(grasp_data.sdf, "... -> 1 1 ...")
+            sdf_input = grasp_data.sdf[None, None]
 
             so3_output, r3_output = sample(
                 self.model,
                 sdf_input,
                 grasp_data.translation.device,
-                torch.tensor(grasp_data.normalization_scale),
+                self.mesh_tensor(
+                    self._normalization_scale_cache,
+                    grasp_data,
+                    grasp_data.normalization_scale,
+                    self.dtype,
+                ),
                 self.config.training.num_samples_to_log,
                 sdf_path=grasp_data.mesh_path,
             )
-            scene = self.compute_grasp_scene(grasp_data, (r3_output, so3_output))
-
-            self.logger.experiment.log(
-                {
-                    f"train/generated_grasp": scene_to_wandb_3d(scene),
-                }
+            # Collision checking and logging the scene do not need the model, so they
+            # run in the background while training continues. Waiting on the previous
+            # scene raises its errors and keeps at most one scene in flight
+            if self._log_executor is None:
+                self._log_executor = ThreadPoolExecutor(max_workers=1)
+            if self._log_future is not None:
+                self._log_future.result()
+            self._log_future = self._log_executor.submit(
+                self.log_generated_grasp, "train", grasp_data, (r3_output, so3_output)
             )
 
         return loss
 
+    def log_generated_grasp(
+        self,
+        prefix: str,
+        grasp_data: GraspData,
+        r3_so3_outputs: Tuple[torch.Tensor, torch.Tensor],
+    ) -> None:
+        """Log the scene of generated grasps, attached to the next logged step."""
+        scene = self.compute_grasp_scene(grasp_data, r3_so3_outputs)
+
+        self.logger.experiment.log(
+            {
+                f"{prefix}/generated_grasp": scene_to_wandb_3d(scene),
+            },
+            commit=False,
+        )
+
+    def on_train_end(self) -> None:
+        """Wait for the last generated grasp scene to be logged."""
+        if self._log_executor is not None:
+            self._log_executor.shutdown(wait=True)
+            self._log_executor = None
+        if self._log_future is not None:
+            future, self._log_future = self._log_future, None
+            future.result()
+
     def validation_step(self, batch: Tuple, batch_idx: int) -> Dict[str, Tensor]:
         grasp_data = batch
-        with torch.enable_grad():
-            loss, log_dict = self.compute_loss(
-                grasp_data.rotation,
-                grasp_data.translation,
-                grasp_data.sdf,
-                grasp_data.mesh_path,
-                grasp_data.normalization_scale,
-                "val",
-            )
+        # Runs under Lightning's no_grad, no activations are kept for a backward pass
+        loss, log_dict = self.compute_loss(
+            grasp_data.rotation,
+            grasp_data.translation,
+            grasp_data.sdf,
+            grasp_data.mesh_path,
+            grasp_data.normalization_scale,
+            "val",
+        )
 
         # Log validation metrics
         self.log_dict(
@@ -183,15 +324,26 @@ class Lightning(pl.LightningModule):
         total_steps = self.trainer.estimated_stepping_batches
 
         # Single linear scheduler with warmup
-        scheduler = torch.optim.lr_scheduler.OneCycleLR(
-            optimizer,
-            max_lr=self.config.training.learning_rate,
-            total_steps=total_steps,
-            pct_start=self.config.training.warmup_ratio,
-            anneal_strategy="linear",
-            div_factor=3.0,  # initial_lr = max_lr/div_factor
-            final_div_factor=float("inf"),  # final_lr = initial_lr/final_div_factor
-        )
+        if self.config.training.lr_schedule == "one_cycle":
+            scheduler = torch.optim.lr_scheduler.OneCycleLR(
+                optimizer,
+                max_lr=self.config.training.learning_rate,
+                total_steps=total_steps,
+                pct_start=self.config.training.warmup_ratio,
+                anneal_strategy="linear",
+                div_factor=3.0,  # initial_lr = max_lr/div_factor
+                final_div_factor=float("inf"),  # final_lr = initial_lr/final_div_factor
+            )
+        else:
+            scheduler = torch.optim.lr_scheduler.LambdaLR(
+                optimizer,
+                partial(
+                    linear_warmup_decay,
+                    total_steps=total_steps,
+                    warmup_ratio=self.config.training.warmup_ratio,
+                    div_factor=3.0,  # initial_lr = learning_rate/div_factor
+                ),
+            )
 
         return {
             "optimizer": optimizer,
@@ -285,24 +437,19 @@ class Lightning(pl.LightningModule):
             )
 
     def duplicate_to_batch_size(self, input: Tensor, batch_size: int):
-        current_size = input.size(0)
-        if current_size >= batch_size:
-            return input
-
-        num_copies = batch_size // current_size
-        remainder = batch_size % current_size
-
-        duplicated = input.repeat(num_copies, *(1 for _ in range(len(input.shape) - 1)))
-        if remainder > 0:
-            duplicated = torch.cat([duplicated, input[:remainder]], dim=0)
-
-        return duplicated
+        return self.model.duplicate_to_batch_size(input, batch_size)
 
     def compute_grasp_scene(
         self,
         grasp_data: GraspData,
         r3_so3_inputs: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
+        loaded_object: Optional[LoadedObject] = None,
     ):
+        """Collision scene of the grasps of grasp_data, or of the given generated ones.
+
+        loaded_object is the object of grasp_data as returned by load_object, for
+        callers that already hold it. Otherwise it is loaded (cached) from its path.
+        """
         # Get normalized translation and rotation from inputs or grasp_data
         normalized_translation, rotation = (
             r3_so3_inputs
@@ -314,14 +461,19 @@ class Lightning(pl.LightningModule):
         denormalized_translation = denormalize_translation(
             normalized_translation, self.translation_norm_params
         )
-        final_translation = denormalized_translation + torch.tensor(
-            grasp_data.centroid, device=denormalized_translation.device
+        centroid = self.mesh_tensor(
+            self._centroid_cache, grasp_data, grasp_data.centroid
+        )
+        final_translation = denormalized_translation + centroid.to(
+            denormalized_translation.device
         )
         has_collision, scene, min_distance, is_graspable = check_collision(
             rotation,
             final_translation,
             grasp_data.mesh_path,
             grasp_data.dataset_mesh_scale,
+            compute_distance=False,
+            loaded_object=loaded_object,
         )
         return scene
 
@@ -330,13 +482,18 @@ class Lightning(pl.LightningModule):
 
         grasp_data = get_grasp_from_batch(batch)
 
-        sdf_input = rearrange(grasp_data.sdf, "... -> 1 1 ...")
+        sdf_input = grasp_data.sdf[None, None]
 
         so3_output, r3_output = sample(
             self.model,
             sdf_input,
             grasp_data.translation.device,
-            torch.tensor(grasp_data.normalization_scale),
+            self.mesh_tensor(
+                self._normalization_scale_cache,
+                grasp_data,
+                grasp_data.normalization_scale,
+                self.dtype,
+            ),
             self.config.training.num_samples_to_log,
             sdf_path=grasp_data.mesh_path,
         )
@@ -376,7 +533,7 @@ class Lightning(pl.LightningModule):
         real_translations = grasp_data.translation
         real_sdf = grasp_data.sdf
         sdf_path = grasp_data.mesh_path  # Usually all are the same in one batch
-        sdf_input = rearrange(real_sdf, "... -> 1 1 ...")
+        sdf_input = real_sdf[None, None]
         print(sdf_input.shape, "sdf_input_size")
         # Generate synthetic grasps
         # (Example: sample 2000 predictions)
@@ -384,7 +541,12 @@ class Lightning(pl.LightningModule):
             self.model,
             sdf_input,  # shape [1, ...]
             device=real_rotations.device,
-            normalization_scale=torch.tensor(grasp_data.normalization_scale),
+            normalization_scale=self.mesh_tensor(
+                self._normalization_scale_cache,
+                grasp_data,
+                grasp_data.normalization_scale,
+                self.dtype,
+            ),
             num_samples=2,
             sdf_path=sdf_path,
         )
@@ -1,6 +1,5 @@
 import torch
 import torch.nn as nn
-from einops import rearrange
 
 
 class VoxelSDFEncoder(nn.Module):
@@ -61,8 +60,8 @@ class VoxelSDFEncoder(nn.Module):
         x = self.avg_pool(x)
         # Shape after avg_pool: (batch_size, 256, 1, 1, 1)
 
-        # Flatten using einops: (batch, channels, 1, 1, 1) -> (batch, channels)
-        x = rearrange(x, "b c d h w -> b (c d h w)")
+        # Flatten: (batch, channels, 1, 1, 1) -> (batch, channels)
+        x = x.flatten(start_dim=1)
         # Shape after flatten: (batch_size, 256)
         return x
 
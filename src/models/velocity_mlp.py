@@ -1,8 +1,10 @@
+from collections import OrderedDict
 from typing import Tuple, Union
+import numpy as np
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from torch import Tensor
-from einops import rearrange
 from src.models.sdf_encoder import VoxelSDFEncoder
 from src.core.config import ExperimentConfig
 from typing import List,Optional
@@ -21,7 +23,10 @@ class VelocityNetwork(nn.Module):
         hidden_dim = config.model.hidden_dim  # 128
         num_hidden_layers = config.model.num_hidden_layers  # 3
         voxel_output_size = config.model.voxel_output_size  # 256
-        self.sdf_encoder = VoxelSDFEncoder().float()
+        self.sdf_encoder = VoxelSDFEncoder()
+        # LRU cache of encoded SDFs keyed by mesh path, only used while the encoder is frozen
+        self.sdf_cache_size = config.model.sdf_cache_size
+        self._sdf_cache: "OrderedDict[str, Tensor]" = OrderedDict()
         # Time embedding
         self.time_proj = nn.Sequential(nn.Linear(1, hidden_dim), activation())
 
@@ -38,6 +43,15 @@ class VelocityNetwork(nn.Module):
         # Output projection
         self.final = nn.Linear(hidden_dim, input_dim)
 
+        # Whether the network and its sampling steps run compiled
+        self.compiled = config.model.compile
+        if config.model.compile:
+            # Compiled in place, so parameter names and checkpoints are unchanged.
+            # The MLP only sees fixed batch shapes, the encoder a varying number of
+            # unique SDFs. The path based dedup and cache stay outside the graphs.
+            self.sdf_encoder.compile()
+            self.velocity_head = torch.compile(self.velocity_head, dynamic=False)
+
     def forward(
         self,
         so3_inputs: Tensor,
@@ -47,6 +61,8 @@ class VelocityNetwork(nn.Module):
         #dataset_mesh_scale: float,
         normalization_scale: Tensor,
         sdf_path: Optional[Tuple[str]]=None,
+        body_frame: bool = False,
+        batch_index: Optional[Tensor] = None,
     ) -> Tuple[Tensor, Tensor]:
         """Forward pass computing velocities for both SO3 and R3 components.
 
@@ -55,6 +71,10 @@ class VelocityNetwork(nn.Module):
             r3_input: R3 input tensor [batch, 3]
             sdf_input: SDF input tensor [batch, 48, 48, 48]
             t: Time tensor [batch] or [batch, 1]
+            body_frame: Return the SO3 velocity as the skew-symmetric body velocity
+                instead of the tangent vector at so3_input
+            batch_index: Index of each input's SDF and normalization scale, for inputs
+                duplicated with duplicate_indices [batch]
 
         Returns:
             Tuple of (so3_velocity [batch, 3, 3], r3_velocity [batch, 3])
@@ -75,22 +95,51 @@ class VelocityNetwork(nn.Module):
         normalization_scale = normalization_scale.to(device=so3_inputs.device, 
                                                     dtype=so3_inputs.dtype)
         #print(sdf_features.shape)
-        if sdf_features.shape[0] != so3_inputs.shape[0]:
+        # Gather the features of duplicated inputs, cheaper than duplicating the SDFs
+        if batch_index is not None:
+            if sdf_features.shape[0] > 1:
+                sdf_features = sdf_features.index_select(0, batch_index)
+            if normalization_scale.shape[0] > 1:
+                normalization_scale = normalization_scale.index_select(0, batch_index)
+        # A single SDF is not duplicated, its features broadcast in velocity_head
+        if sdf_features.shape[0] not in (1, so3_inputs.shape[0]):
             sdf_features = self.duplicate_to_batch_size(sdf_features,so3_inputs.shape[0])
+        if normalization_scale.shape[0] != so3_inputs.shape[0]:
             normalization_scale = self.duplicate_to_batch_size(normalization_scale,so3_inputs.shape[0])
 
+        return self.velocity_head(
+            so3_inputs, r3_inputs, sdf_features, t, normalization_scale, body_frame
+        )
+
+    def velocity_head(
+        self,
+        so3_inputs: Tensor,
+        r3_inputs: Tensor,
+        sdf_features: Tensor,
+        t: Tensor,
+        normalization_scale: Tensor,
+        body_frame: bool = False,
+    ) -> Tuple[Tensor, Tensor]:
+        """MLP from encoded SDF features and state to velocities, see forward."""
         # Flatten SO3 input for processing
-        so3_flat = rearrange(so3_inputs, "b c d -> b (c d)")
+        so3_flat = so3_inputs.reshape(so3_inputs.size(0), 9)
 
-        # Combine inputs
-        x = torch.cat([sdf_features, so3_flat, r3_inputs,normalization_scale], dim=-1)
+        # Combine inputs. input_proj acts on [sdf_features, so3, r3, normalization_scale],
+        # applied blockwise so the SDF features are never concatenated per sample and
+        # a single SDF is projected once for the whole batch
+        voxel_output_size = sdf_features.shape[-1]
+        state = torch.cat([so3_flat, r3_inputs, normalization_scale], dim=-1)
 
-        # Process time and state
-        t_emb = self.time_proj(t)
-        h = self.input_proj(x)
+        # Process time. time_proj is Linear(1, hidden) + activation, an outer product
+        # that is computed elementwise rather than as a GEMM with a single input
+        time_linear, time_activation = self.time_proj
+        t_emb = time_activation(torch.addcmul(time_linear.bias, t, time_linear.weight.T))
 
-        # Combine time embedding and state
-        h = h + t_emb
+        # Process state and combine with the time embedding, accumulated by the GEMM
+        h = torch.addmm(t_emb, state, self.input_proj.weight[:, voxel_output_size:].T)
+        h = h + F.linear(
+            sdf_features, self.input_proj.weight[:, :voxel_output_size], self.input_proj.bias
+        )
 
         # Pass through hidden layers and get combined velocity
         h = self.hidden_layers(h)
@@ -101,58 +150,142 @@ class VelocityNetwork(nn.Module):
         r3_velocity = combined_velocity[:, 9:]
 
         # Reshape SO3 velocity back to matrix form for tangent space projection
-        so3_velocity = rearrange(so3_velocity_flat, "b (c d) -> b c d", c=3, d=3)
+        so3_velocity = so3_velocity_flat.reshape(-1, 3, 3)
 
-        # Project to tangent space
-        skew_symmetric_part = 0.5 * (so3_velocity - so3_velocity.permute(0, 2, 1))
+        # Project to tangent space. The transpose is a view, so scaling the difference
+        # in place leaves a single [batch, 3, 3] allocation
+        skew_symmetric_part = (so3_velocity - so3_velocity.transpose(-2, -1)).mul_(0.5)
+        if body_frame:
+            return skew_symmetric_part, r3_velocity
         so3_velocity = so3_inputs @ skew_symmetric_part
 
         return so3_velocity, r3_velocity
 
 
 
+    def duplicate_indices(self,current_size:int,target_batch_size:int,duplicate_ratio:int = 1,
+                          device: Optional[torch.device] = None) -> Optional[Tensor]:
+        """Indices duplicating a batch to target_batch_size, None if it is kept as is.
+
+        The batch is tiled, so the first current_size indices are the batch itself,
+        followed by random entries for any remainder. Unlike duplicate_to_batch_size
+        the remainder is random, as one index is shared by all duplicated inputs.
+        """
+        if (current_size>=target_batch_size) and (duplicate_ratio == 1):
+            return None
+        elif duplicate_ratio > 1:
+            num_copies, remainder = duplicate_ratio, 0
+        else:
+            num_copies, remainder = divmod(target_batch_size, current_size)
+
+        indices = torch.arange(num_copies * current_size, device=device) % current_size
+        if remainder > 0:
+            extra = torch.randperm(current_size, device=device)[:remainder]
+            indices = torch.cat([indices, extra])
+        return indices
+
     def duplicate_to_batch_size(self,input:Tensor,target_batch_size:int,duplicate_ratio:int = 1):
         current_size = input.size(0)
         if (current_size>=target_batch_size) and (duplicate_ratio == 1):
             return input
         elif duplicate_ratio > 1:
-            duplicated = input.repeat(
-            duplicate_ratio, *(1 for _ in range(len(input.shape) - 1))
-        )
-            return duplicated
+            num_copies, remainder = duplicate_ratio, 0
         else: 
-            num_copies = target_batch_size // current_size
-            remainder = target_batch_size % current_size
-
-            duplicated = input.repeat(
-                num_copies, *(1 for _ in range(len(input.shape) - 1))
-            )
-            if remainder > 0:
-                duplicated = torch.cat([duplicated, input[:remainder]], dim=0)
-            
-            return duplicated
+            num_copies, remainder = divmod(target_batch_size, current_size)
+
+        if current_size == 1 and remainder == 0:
+            # Broadcast view of the single entry, nothing is copied
+            return input.expand(num_copies, *input.shape[1:])
+
+        duplicated = input.repeat(
+            num_copies, *(1 for _ in range(len(input.shape) - 1))
+        )
+        if remainder > 0:
+            # The first entries fill the remainder, so inputs duplicated by separate
+            # calls stay paired row by row
+            duplicated = torch.cat([duplicated, input[:remainder]], dim=0)
+        
+        return duplicated
     
+    def train(self, mode: bool = True):
+        # Encoder weights change during training, so cached features go stale
+        if mode:
+            self._sdf_cache.clear()
+        return super().train(mode)
+
+    def sdf_cache_enabled(self) -> bool:
+        """Whether encoded SDFs can be reused, i.e. the encoder is not being trained."""
+        encoder_training = self.sdf_encoder.training and any(
+            p.requires_grad for p in self.sdf_encoder.parameters()
+        )
+        return self.sdf_cache_size > 0 and not encoder_training
+
+    def cached_sdf_forward(self, sdf_input: Tensor, sdf_paths: List[str]) -> Tensor:
+        """Encode one SDF per unique path, skipping the encoder for cached paths.
+
+        Args:
+            sdf_input: SDF tensor [len(sdf_paths), ...]
+            sdf_paths: Unique mesh paths of the SDFs
+
+        Returns:
+            Encoded SDF features [len(sdf_paths), voxel_output_size]
+        """
+        # Features are cached in the encoder's own dtype, not in whatever autocast
+        # produced, so they can be reused by full precision callers such as sample()
+        dtype = next(self.sdf_encoder.parameters()).dtype
+        features = [self._sdf_cache.get(sdf_path) for sdf_path in sdf_paths]
+        missing = [
+            i for i, feature in enumerate(features)
+            if feature is None or feature.device != sdf_input.device
+        ]
+        if missing:
+            encoded_missing = self.sdf_encoder(sdf_input[missing]).detach().to(dtype)
+            for i, feature in zip(missing, encoded_missing):
+                features[i] = feature
+                self._sdf_cache[sdf_paths[i]] = feature
+
+        # Mark as recently used and evict the least recently used paths
+        for sdf_path in sdf_paths:
+            self._sdf_cache.move_to_end(sdf_path)
+        while len(self._sdf_cache) > self.sdf_cache_size:
+            self._sdf_cache.popitem(last=False)
+
+        return torch.stack(features)
+
     def efficient_sdf_forward(self,sdf_input: Tensor,sdf_paths: Union[str, Tuple[str]]):
         
         if isinstance(sdf_paths, str):
+            if self.sdf_cache_enabled():
+                # A single path means a single SDF, duplicated to the batch in forward
+                return self.cached_sdf_forward(sdf_input[:1], [sdf_paths])
             return self.sdf_encoder(sdf_input)  
-        unique_sdf_paths = []
-        unique_indices = []  # indices into 'batch'
-        filename_to_unique_idx = {}
-        
-        for i, sdf_path in enumerate(sdf_paths):
-            if sdf_path not in filename_to_unique_idx:
-                # This is the first time we see filename f
-                filename_to_unique_idx[sdf_path] = len(unique_sdf_paths)  # e.g. 0, 1, 2, ...
-                unique_sdf_paths.append(sdf_path)
-                unique_indices.append(i)
-                
-        mapping = []
-        for sdf_path in sdf_paths:
-            mapping.append(filename_to_unique_idx[sdf_path])
-        mapping = torch.tensor(mapping, dtype=torch.int)  # shape (N,)
-        
-        unique_batch = sdf_input[unique_indices]
-        encoded_unique = self.sdf_encoder(unique_batch)
+        # Sorted unique paths, the index of their first occurrence in the batch
+        # and the index of each batch entry's path among the unique paths
+        unique_sdf_paths, unique_indices, mapping = np.unique(
+            np.asarray(sdf_paths), return_index=True, return_inverse=True
+        )
+        unique_sdf_paths = unique_sdf_paths.tolist()
+
+        # Avoid gathering a copy of the SDFs where a view of the batch suffices
+        if len(unique_sdf_paths) == len(sdf_paths):
+            # All unique: encode the batch as is, in batch order
+            unique_sdf_paths = list(sdf_paths)
+            unique_batch = sdf_input
+            mapping = None
+        elif len(unique_sdf_paths) == 1:
+            # A single SDF, its features broadcast over the batch in forward
+            unique_batch = sdf_input[unique_indices[0] : unique_indices[0] + 1]
+            mapping = None
+        else:
+            unique_indices = torch.from_numpy(unique_indices).to(sdf_input.device, non_blocking=True)
+            mapping = torch.from_numpy(mapping.reshape(-1)).to(sdf_input.device, non_blocking=True)  # shape (N,)
+            unique_batch = sdf_input[unique_indices]
+
+        if self.sdf_cache_enabled():
+            encoded_unique = self.cached_sdf_forward(unique_batch, unique_sdf_paths)
+        else:
+            encoded_unique = self.sdf_encoder(unique_batch)
+        if mapping is None:
+            return encoded_unique
         final_output = encoded_unique[mapping]
         return final_output
@@ -0,0 +1,50 @@
+import torch
+
+from src.core.config import ExperimentConfig
+from src.models.flow import random_rotation_matrices, sample
+from src.models.lightning import Lightning
+
+
+def test_sample_after_mixed_precision_validation():
+    """A BF16 mixed precision validation pass followed by sampling, as in training."""
+    torch.manual_seed(0)
+    config = ExperimentConfig.default_mlp()
+    assert config.training.precision == "bf16-mixed"
+    module = Lightning(config).eval()
+    batch_size = 4
+    sdf = torch.randn(1, 1, 48, 48, 48)
+    # Features as CUDA autocast produces them, CPU autocast pools in FP32
+    module.model.sdf_encoder.register_forward_hook(
+        lambda module, inputs, output: (
+            output.bfloat16() if torch.is_autocast_enabled("cpu") else output
+        )
+    )
+
+    with torch.no_grad(), torch.autocast("cpu", dtype=torch.bfloat16):
+        _, log_dict = module.compute_loss(
+            random_rotation_matrices(batch_size),
+            torch.rand(batch_size, 3) * 2 - 1,
+            sdf.expand(batch_size, -1, -1, -1, -1),
+            ("mesh.obj",) * batch_size,
+            torch.ones(batch_size),
+            "val",
+        )
+        assert all(torch.isfinite(value) for value in log_dict.values())
+
+        # Sampling is called from steps running under autocast
+        so3_samples, r3_samples = sample(
+            module.model,
+            sdf,
+            torch.device("cpu"),
+            torch.tensor(1.0),
+            num_samples=batch_size,
+            steps=2,
+            sdf_path="mesh.obj",
+        )
+
+    assert so3_samples.dtype == torch.float32
+    assert r3_samples.dtype == torch.float32
+    identity = torch.eye(3).expand(batch_size, 3, 3)
+    assert torch.allclose(
+        so3_samples.transpose(-2, -1) @ so3_samples, identity, atol=1e-4
+    )
@@ -0,0 +1,42 @@
+import torch
+
+from src.core.config import ExperimentConfig
+from src.models.flow import random_rotation_matrices, sample
+from src.models.velocity_mlp import VelocityNetwork
+
+
+def test_sample_after_autocast_eval_reuses_cached_sdf_features():
+    """SDF features cached in an autocast eval pass are usable by sample()."""
+    torch.manual_seed(0)
+    model = VelocityNetwork(ExperimentConfig.default_mlp()).eval()
+    sdf = torch.randn(1, 1, 48, 48, 48)
+    batch_size = 4
+    # Features as CUDA autocast produces them, CPU autocast pools in FP32
+    model.sdf_encoder.register_forward_hook(
+        lambda module, inputs, output: (
+            output.bfloat16() if torch.is_autocast_enabled("cpu") else output
+        )
+    )
+
+    with torch.no_grad(), torch.autocast("cpu", dtype=torch.bfloat16):
+        model(
+            random_rotation_matrices(batch_size),
+            torch.randn(batch_size, 3),
+            sdf.expand(batch_size, -1, -1, -1, -1),
+            torch.rand(batch_size),
+            torch.ones(batch_size),
+            ("mesh.obj",) * batch_size,
+        )
+    assert model._sdf_cache["mesh.obj"].dtype == torch.float32
+
+    so3_samples, r3_samples = sample(
+        model,
+        sdf,
+        torch.device("cpu"),
+        torch.tensor(1.0),
+        num_samples=batch_size,
+        steps=2,
+        sdf_path="mesh.obj",
+    )
+    assert so3_samples.dtype == torch.float32
+    assert r3_samples.dtype == torch.float32